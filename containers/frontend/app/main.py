@@ -1,15 +1,24 @@
 import os
+import io
 import json
+import time
+import struct
+import zipfile
 import requests
 import uvicorn
 import base64
-from fastapi import FastAPI, HTTPException, Response, File, Request
-from fastapi.responses import HTMLResponse, RedirectResponse
+from typing import List
+from fastapi import FastAPI, HTTPException, Response, File, Request, Query
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes, hmac, padding
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 
 PRIVATE_KEY = os.environ.get("PRIVATE_KEY")
 SERVER = "https://tv.vankrupt.net"
 DATA_DIR = "data"
+# Multiple of 3 so every chunk base64-encodes without padding
+EXPORT_CHUNK_SIZE = 3 * 64 * 1024
 
 HEADERS = {
     "Host": "tv.vankrupt.net",
@@ -157,5 +166,140 @@ def upload(request: Request, file: bytes = File(...)):
     
     return {"ok": True}
 
+def get_export_dir(replay_id):
+    if not replay_id.isalnum():
+        raise HTTPException(status_code=404)
+
+    replay_dir = os.path.join(DATA_DIR, replay_id)
+    if not os.path.isfile(os.path.join(replay_dir, "metadata.json")):
+        raise HTTPException(status_code=404, detail="Replay not downloaded.")
+    return replay_dir
+
+def get_export_keys():
+    # Checked before streaming starts, a bad key mid-stream would still send a 200
+    try:
+        Fernet(PRIVATE_KEY)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=500, detail="PRIVATE_KEY is not a valid Fernet key.")
+
+    key = base64.urlsafe_b64decode(PRIVATE_KEY)
+    return key[:16], key[16:]
+
+def export_file_sort_key(name):
+    # Keep stream.2 before stream.10
+    base, _, suffix = name.partition(".")
+    index, _, rest = suffix.partition(".")
+    if index.isdigit():
+        return (base, int(index), rest)
+    return (base, -1, suffix)
+
+def iter_replay_json(replay_dir):
+    # Same layout /upload reads: {"data": <metadata>, "files": {name: base64}}
+    with open(os.path.join(replay_dir, "metadata.json"), "rb") as f:
+        metadata = f.read()
+    yield b'{"data": ' + metadata + b', "files": {'
+
+    names = sorted(
+        (name for name in os.listdir(replay_dir)
+         if name != "metadata.json" and os.path.isfile(os.path.join(replay_dir, name))),
+        key=export_file_sort_key
+    )
+    for index, name in enumerate(names):
+        yield (b", " if index else b"") + json.dumps(name).encode() + b': "'
+        with open(os.path.join(replay_dir, name), "rb") as f:
+            while True:
+                chunk = f.read(EXPORT_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield base64.b64encode(chunk)
+        yield b'"'
+    yield b"}}"
+
+def iter_fernet_token(keys, chunks):
+    # Builds the same token as Fernet(PRIVATE_KEY).encrypt() without holding
+    # the plaintext: version | timestamp | iv | AES-CBC ciphertext | HMAC
+    signing_key, encryption_key = keys
+    iv = os.urandom(16)
+    encryptor = Cipher(algorithms.AES(encryption_key), modes.CBC(iv)).encryptor()
+    padder = padding.PKCS7(algorithms.AES.block_size).padder()
+    signer = hmac.HMAC(signing_key, hashes.SHA256())
+
+    def sign(data):
+        signer.update(data)
+        return data
+
+    yield sign(b"\x80" + struct.pack(">Q", int(time.time())) + iv)
+    for chunk in chunks:
+        yield sign(encryptor.update(padder.update(chunk)))
+    yield sign(encryptor.update(padder.finalize()) + encryptor.finalize())
+    yield signer.finalize()
+
+def iter_urlsafe_base64(chunks):
+    remainder = b""
+    for chunk in chunks:
+        data = remainder + chunk
+        cut = len(data) - len(data) % 3
+        remainder = data[cut:]
+        if cut:
+            yield base64.urlsafe_b64encode(data[:cut])
+    if remainder:
+        yield base64.urlsafe_b64encode(remainder)
+
+def iter_export(replay_dir, keys):
+    return iter_urlsafe_base64(iter_fernet_token(keys, iter_replay_json(replay_dir)))
+
+class ZipStreamBuffer(io.RawIOBase):
+    # Unseekable sink so zipfile writes data descriptors instead of seeking back
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def iter_export_bundle(replays, keys):
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, "w", compression=zipfile.ZIP_DEFLATED) as bundle:
+        for replay_id, replay_dir in replays:
+            # Entry size is unknown up front and can pass 2 GiB
+            with bundle.open(f"{replay_id}.pavlovtv", "w", force_zip64=True) as entry:
+                for chunk in iter_export(replay_dir, keys):
+                    entry.write(chunk)
+                    data = buffer.drain()
+                    if data:
+                        yield data
+            data = buffer.drain()
+            if data:
+                yield data
+    yield buffer.drain()
+
+@app.get("/export/{replay_id}")
+def export_replay(replay_id: str):
+    replay_dir = get_export_dir(replay_id)
+    keys = get_export_keys()
+    return StreamingResponse(
+        iter_export(replay_dir, keys),
+        media_type="application/octet-stream",
+        headers={"Content-Disposition": f'attachment; filename="{replay_id}.pavlovtv"'}
+    )
+
+@app.get("/export")
+def export_replays(replay_id: List[str] = Query(...)):
+    replays = [(item, get_export_dir(item)) for item in dict.fromkeys(replay_id)]
+    keys = get_export_keys()
+    return StreamingResponse(
+        iter_export_bundle(replays, keys),
+        media_type="application/zip",
+        headers={"Content-Disposition": 'attachment; filename="replays.zip"'}
+    )
+
 if __name__ == "__main__":
     uvicorn.run(app, host="127.0.0.1", port=8081)